@@ -4,10 +4,10 @@
 # and mail aliases and restarts nsd.
 ########################################################################
 
-import sys, os, os.path, urllib.parse, datetime, re, hashlib, base64
+import sys, os, os.path, urllib.parse, datetime, re, hashlib, base64, glob, functools, multiprocessing.pool
 import ipaddress
 import rtyaml
-import dns.resolver
+import dns.resolver, dns.rdata, dns.rdataclass, dns.rdatatype
 
 from mailconfig import get_mail_domains, get_mail_aliases
 from utils import shell, load_env_vars_from_file, safe_domain_name, sort_domains
@@ -17,7 +17,16 @@ from ssl_certificates import get_ssl_certificates, check_certificate
 # This regular expression matches domain names according to RFCs, it also accepts fqdn with an leading dot,
 # underscores, as well as asteriks which are allowed in domain names but not hostnames (i.e. allowed in
 # DNS but not in URLs), which are common in certain record types like for DKIM.
-DOMAIN_RE = "^(?!\-)(?:[*][.])?(?:[a-zA-Z\d\-_]{0,62}[a-zA-Z\d_]\.){1,126}(?!\d+)[a-zA-Z\d_]{1,63}(\.?)$"
+DOMAIN_RE = re.compile(r"^(?!\-)(?:[*][.])?(?:[a-zA-Z\d\-_]{0,62}[a-zA-Z\d_]\.){1,126}(?!\d+)[a-zA-Z\d_]{1,63}(\.?)$")
+
+# Matches the DKIM TXT record file generated by OpenDKIM, capturing the
+# qname and the quoted strings that make up the value, and then each of
+# those strings.
+DKIM_RECORD_RE = re.compile(r'(\S+)\s+IN\s+TXT\s+\( ((?:"[^"]+"\s+)+)\)', re.S)
+DKIM_STRING_RE = re.compile(r'"([^"]+)"')
+
+# Characters that must be escaped within a quoted TXT record string.
+TXT_ESCAPES = str.maketrans({ '\\': '\\\\', '"': '\\"' })
 
 def get_dns_domains(env):
 	# Add all domain names in use by email users and mail aliases and ensure
@@ -33,11 +42,14 @@ def get_dns_zones(env):
 	domains = get_dns_domains(env)
 
 	# Exclude domains that are subdomains of other domains we know. Proceed
-	# by looking at shorter domains first.
+	# by looking at shorter domains first. Rather than comparing against
+	# every zone found so far, check each parent domain (by stripping off
+	# labels) against the set of zones.
 	zone_domains = set()
 	for domain in sorted(domains, key=lambda d : len(d)):
-		for d in zone_domains:
-			if domain.endswith("." + d):
+		labels = domain.split(".")
+		for i in range(1, len(labels)):
+			if ".".join(labels[i:]) in zone_domains:
 				# We found a parent domain already in the list.
 				break
 		else:
@@ -53,18 +65,65 @@ def get_dns_zones(env):
 	# stable order so we don't rewrite the file & restart the service
 	# meaninglessly.
 	zone_order = sort_domains([ zone[0] for zone in zonefiles ], env)
-	zonefiles.sort(key = lambda zone : zone_order.index(zone[0]) )
+	zone_rank = { domain: i for i, domain in enumerate(zone_order) }
+	zonefiles.sort(key = lambda zone : zone_rank[zone[0]] )
 
 	return zonefiles
 
+def get_dns_update_fingerprint(env):
+	# Returns a hash of everything the DNS zones are built from: the system
+	# configuration, the modification times of the files the records come
+	# from, and today's date (since whether MTA-STS records are included
+	# depends on certificates not having expired). Include this code too
+	# (and the modules it uses) so that an upgrade that changes what records
+	# we generate takes effect right away.
+	fns = [
+		os.path.join(env['STORAGE_ROOT'], 'mail/users.sqlite'),
+		os.path.join(env['STORAGE_ROOT'], 'dns/custom.yaml'),
+		os.path.join(env['STORAGE_ROOT'], 'mail/dkim/mail.txt'),
+		'/var/lib/mailinabox/mta-sts.txt',
+	]
+	fns += sorted(glob.glob('/etc/ssh/ssh_host_*_key.pub'))
+	fns += sorted(glob.glob(os.path.join(os.path.dirname(os.path.abspath(__file__)), '*.py')))
+	for root, dirs, files in os.walk(os.path.join(env['STORAGE_ROOT'], 'ssl')):
+		dirs.sort()
+		fns += [os.path.join(root, fn) for fn in sorted(files)]
+
+	fingerprint = [
+		sorted(env.items()),
+		datetime.date.today().isoformat(),
+		[get_file_stamp(fn) for fn in fns],
+	]
+	return hashlib.sha256(repr(fingerprint).encode("utf8")).hexdigest()
+
 def do_dns_update(env, force=False):
 	# Write zone files.
 	os.makedirs('/etc/nsd/zones', exist_ok=True)
-	zonefiles = []
+	zones = get_dns_zones(env)
+	zonefiles = [(domain, zonefile + ".signed") for domain, zonefile in zones] # the final set of files will be signed
 	updated_domains = []
-	for (domain, zonefile, records) in build_zones(env):
-		# The final set of files will be signed.
-		zonefiles.append((domain, zonefile + ".signed"))
+	zones_to_sign = []
+
+	# If nothing that goes into the zones has changed since the last update,
+	# only zones whose signatures are about to expire (or that are missing)
+	# need to be rebuilt. Otherwise rebuild all of them and let write_nsd_zone
+	# compare them to what's on disk.
+	fingerprint_file = '/etc/nsd/zones/.fingerprint'
+	fingerprint = get_dns_update_fingerprint(env)
+	last_fingerprint = None
+	if os.path.exists(fingerprint_file):
+		with open(fingerprint_file) as f:
+			last_fingerprint = f.read()
+	if fingerprint == last_fingerprint and not force:
+		domains_to_update = set(domain for domain, zonefile in zones
+			if not os.path.exists("/etc/nsd/zones/" + zonefile)
+			or is_zone_signature_expiring("/etc/nsd/zones/" + zonefile))
+	else:
+		domains_to_update = set(domain for domain, zonefile in zones)
+
+	for (domain, zonefile, records) in (build_zones(env) if domains_to_update else []):
+		if domain not in domains_to_update:
+			continue
 
 		# See if the zone has changed, and if so update the serial number
 		# and write the zone file.
@@ -75,7 +134,7 @@ def do_dns_update(env, force=False):
 		# Mark that we just updated this domain.
 		updated_domains.append(domain)
 
-		# Sign the zone.
+		# Queue the zone for signing.
 		#
 		# Every time we sign the zone we get a new result, which means
 		# we can't sign a zone without bumping the zone's serial number.
@@ -84,7 +143,19 @@ def do_dns_update(env, force=False):
 		# write_nsd_zone is smart enough to check if a zone's signature
 		# is nearing expiration and if so it'll bump the serial number
 		# and return True so we get a chance to re-sign it.
-		sign_zone(domain, zonefile, env)
+		zones_to_sign.append((domain, zonefile))
+
+	# Sign the zones. Signing is done by separate ldns processes for each
+	# zone, so sign zones in parallel. Use processes rather than threads
+	# because sign_zone changes the process's umask.
+	if len(zones_to_sign) > 0:
+		with multiprocessing.pool.Pool(processes=min(os.cpu_count() or 1, len(zones_to_sign))) as pool:
+			pool.starmap(sign_zone, [(domain, zonefile, env) for domain, zonefile in zones_to_sign]) # re-raises any exception
+
+	# Remember what the zones were built from.
+	if fingerprint != last_fingerprint:
+		with open(fingerprint_file, "w") as f:
+			f.write(fingerprint)
 
 	# Write the main nsd.conf file.
 	if write_nsd_conf(zonefiles, list(get_custom_dns_config(env)), env):
@@ -117,7 +188,30 @@ def do_dns_update(env, force=False):
 
 ########################################################################
 
+class Record:
+	# A DNS record in a zone. qname is relative to the zone's domain, or None
+	# for the domain itself. explanation is shown to the user in the control
+	# panel, or is False for records that aren't shown.
+	__slots__ = ("qname", "rtype", "value", "explanation")
+
+	def __init__(self, qname, rtype, value, explanation):
+		self.qname = qname
+		self.rtype = rtype
+		self.value = value
+		self.explanation = explanation
+
+_zones = None
 def build_zones(env):
+	# Building the records for every zone is slow and both do_dns_update and
+	# build_recommended_dns need them, often right after one another, so
+	# reuse the last result until anything that goes into the zones changes.
+	global _zones
+	cache_key = get_dns_update_fingerprint(env)
+	if _zones is None or _zones[0] != cache_key:
+		_zones = (cache_key, list(generate_zones(env)))
+	return _zones[1]
+
+def generate_zones(env):
 	# What domains (and their zone filenames) should we build?
 	domains = get_dns_domains(env)
 	zonefiles = get_dns_zones(env)
@@ -127,13 +221,35 @@ def build_zones(env):
 	from web_update import get_web_domains
 	www_redirect_domains = set(get_web_domains(env)) - set(get_web_domains(env, include_www_redirects=False))
 
+	# The DKIM record is the same for every zone, so read it once.
+	dkim_record = get_dkim_record(env)
+
+	# Group the domains by the zone they fall in, so that build_zone doesn't
+	# have to scan every domain for each zone. Zones are never nested, so
+	# the first parent domain that is a zone is the only one.
+	subdomains_by_zone = { domain: [] for domain, zonefile in zonefiles }
+	for domain in domains:
+		labels = domain.split(".")
+		for i in range(1, len(labels)):
+			parent = ".".join(labels[i:])
+			if parent in subdomains_by_zone:
+				subdomains_by_zone[parent].append(domain)
+				break
+
 	# Build DNS records for each zone.
 	for domain, zonefile in zonefiles:
 		# Build the records to put in the zone.
-		records = build_zone(domain, domains, additional_records, www_redirect_domains, env)
+		records = build_zone(domain, subdomains_by_zone[domain], additional_records, www_redirect_domains, env, dkim_record=dkim_record)
 		yield (domain, zonefile, records)
 
-def build_zone(domain, all_domains, additional_records, www_redirect_domains, env, is_zone=True):
+def get_dkim_record(env):
+	# Returns the qname and value of the DKIM TXT record generated by OpenDKIM.
+	opendkim_record_file = os.path.join(env['STORAGE_ROOT'], 'mail/dkim/mail.txt')
+	with open(opendkim_record_file) as orf:
+		m = DKIM_RECORD_RE.match(orf.read())
+	return (m.group(1), "".join(DKIM_STRING_RE.findall(m.group(2))))
+
+def build_zone(domain, subdomains, additional_records, www_redirect_domains, env, is_zone=True, dkim_record=None):
 	records = []
 
 	# For top-level zones, define the authoritative name servers.
@@ -142,68 +258,75 @@ def build_zone(domain, all_domains, additional_records, www_redirect_domains, en
 	# so we allow the user to override the second nameserver definition so that
 	# secondary DNS can be set up elsewhere.
 	#
-	# 'False' in the tuple indicates these records would not be used if the zone
+	# 'False' as the explanation indicates these records would not be used if the zone
 	# is managed outside of the box.
 	if is_zone:
 		# Obligatory definition of ns1.PRIMARY_HOSTNAME.
-		records.append((None,  "NS",  "ns1.%s." % env["PRIMARY_HOSTNAME"], False))
+		records.append(Record(None,  "NS",  "ns1.%s." % env["PRIMARY_HOSTNAME"], False))
 
 		# Define ns2.PRIMARY_HOSTNAME or whatever the user overrides.
 		# User may provide one or more additional nameservers
 		secondary_ns_list = get_secondary_dns(additional_records, mode="NS") \
 			or ["ns2." + env["PRIMARY_HOSTNAME"]]
 		for secondary_ns in secondary_ns_list:
-			records.append((None,  "NS", secondary_ns+'.', False))
+			records.append(Record(None,  "NS", secondary_ns+'.', False))
 
 
 	# In PRIMARY_HOSTNAME...
 	if domain == env["PRIMARY_HOSTNAME"]:
 		# Define ns1 and ns2.
-		# 'False' in the tuple indicates these records would not be used if the zone
+		# 'False' as the explanation indicates these records would not be used if the zone
 		# is managed outside of the box.
-		records.append(("ns1", "A", env["PUBLIC_IP"], False))
-		records.append(("ns2", "A", env["PUBLIC_IP"], False))
+		records.append(Record("ns1", "A", env["PUBLIC_IP"], False))
+		records.append(Record("ns2", "A", env["PUBLIC_IP"], False))
 		if env.get('PUBLIC_IPV6'):
-			records.append(("ns1", "AAAA", env["PUBLIC_IPV6"], False))
-			records.append(("ns2", "AAAA", env["PUBLIC_IPV6"], False))
+			records.append(Record("ns1", "AAAA", env["PUBLIC_IPV6"], False))
+			records.append(Record("ns2", "AAAA", env["PUBLIC_IPV6"], False))
 
 		# Set the A/AAAA records. Do this early for the PRIMARY_HOSTNAME so that the user cannot override them
 		# and we can provide different explanatory text.
-		records.append((None, "A", env["PUBLIC_IP"], "Required. Sets the IP address of the box."))
-		if env.get("PUBLIC_IPV6"): records.append((None, "AAAA", env["PUBLIC_IPV6"], "Required. Sets the IPv6 address of the box."))
+		records.append(Record(None, "A", env["PUBLIC_IP"], "Required. Sets the IP address of the box."))
+		if env.get("PUBLIC_IPV6"): records.append(Record(None, "AAAA", env["PUBLIC_IPV6"], "Required. Sets the IPv6 address of the box."))
 
 		# Add a DANE TLSA record for SMTP.
-		records.append(("_25._tcp", "TLSA", build_tlsa_record(env), "Recommended when DNSSEC is enabled. Advertises to mail servers connecting to the box that mandatory encryption should be used."))
+		records.append(Record("_25._tcp", "TLSA", build_tlsa_record(env), "Recommended when DNSSEC is enabled. Advertises to mail servers connecting to the box that mandatory encryption should be used."))
 
 		# Add a DANE TLSA record for HTTPS, which some browser extensions might make use of.
-		records.append(("_443._tcp", "TLSA", build_tlsa_record(env), "Optional. When DNSSEC is enabled, provides out-of-band HTTPS certificate validation for a few web clients that support it."))
+		records.append(Record("_443._tcp", "TLSA", build_tlsa_record(env), "Optional. When DNSSEC is enabled, provides out-of-band HTTPS certificate validation for a few web clients that support it."))
 
 		# Add a SSHFP records to help SSH key validation. One per available SSH key on this system.
 		for value in build_sshfp_records():
-			records.append((None, "SSHFP", value, "Optional. Provides an out-of-band method for verifying an SSH key before connecting. Use 'VerifyHostKeyDNS yes' (or 'VerifyHostKeyDNS ask') when connecting with ssh."))
+			records.append(Record(None, "SSHFP", value, "Optional. Provides an out-of-band method for verifying an SSH key before connecting. Use 'VerifyHostKeyDNS yes' (or 'VerifyHostKeyDNS ask') when connecting with ssh."))
 
 	# Add DNS records for any subdomains of this domain. We should not have a zone for
 	# both a domain and one of its subdomains.
-	subdomains = [d for d in all_domains if d.endswith("." + domain)]
 	for subdomain in subdomains:
 		subdomain_qname = subdomain[0:-len("." + domain)]
-		subzone = build_zone(subdomain, [], additional_records, www_redirect_domains, env, is_zone=False)
-		for child_qname, child_rtype, child_value, child_explanation in subzone:
-			if child_qname == None:
+		subzone = build_zone(subdomain, [], additional_records, www_redirect_domains, env, is_zone=False, dkim_record=dkim_record)
+		for child in subzone:
+			if child.qname == None:
 				child_qname = subdomain_qname
 			else:
-				child_qname += "." + subdomain_qname
-			records.append((child_qname, child_rtype, child_value, child_explanation))
-
-	has_rec_base = list(records) # clone current state
+				child_qname = child.qname + "." + subdomain_qname
+			records.append(Record(child_qname, child.rtype, child.value, child.explanation))
+
+	# has_rec looks up records by (qname, rtype) in an index rather than
+	# scanning the whole list of records each time.
+	def index_records(records):
+		index = { }
+		for rec in records:
+			index.setdefault((rec.qname, rec.rtype), []).append(rec.value)
+		return index
+	has_rec_base = index_records(records) # snapshot of current state
 	def has_rec(qname, rtype, prefix=None):
-		for rec in has_rec_base:
-			if rec[0] == qname and rec[1] == rtype and (prefix is None or rec[2].startswith(prefix)):
+		for value in has_rec_base.get((qname, rtype), []):
+			if prefix is None or value.startswith(prefix):
 				return True
 		return False
 
 	# The user may set other records that don't conflict with our settings.
 	# Don't put any TXT records above this line, or it'll prevent any custom TXT records.
+	local_ips = { "A": env["PUBLIC_IP"], "AAAA": env.get("PUBLIC_IPV6") }
 	for qname, rtype, value in filter_custom_records(domain, additional_records):
 		# Don't allow custom records for record types that override anything above.
 		# But allow multiple custom records for the same rtype --- see how has_rec_base is used.
@@ -211,21 +334,18 @@ def build_zone(domain, all_domains, additional_records, www_redirect_domains, en
 
 		# The "local" keyword on A/AAAA records are short-hand for our own IP.
 		# This also flags for web configuration that the user wants a website here.
-		if rtype == "A" and value == "local":
-			value = env["PUBLIC_IP"]
-		if rtype == "AAAA" and value == "local":
-			if "PUBLIC_IPV6" in env:
-				value = env["PUBLIC_IPV6"]
-			else:
-				continue
-		records.append((qname, rtype, value, "(Set by user.)"))
+		if value == "local" and rtype in local_ips:
+			value = local_ips[rtype]
+			if value is None:
+				continue # no IPv6 address
+		records.append(Record(qname, rtype, value, "(Set by user.)"))
 
 	# Add defaults if not overridden by the user's custom settings (and not otherwise configured).
 	# Any CNAME or A record on the qname overrides A and AAAA. But when we set the default A record,
 	# we should not cause the default AAAA record to be skipped because it thinks a custom A record
-	# was set. So set has_rec_base to a clone of the current set of DNS settings, and don't update
+	# was set. So set has_rec_base to a snapshot of the current set of DNS settings, and don't update
 	# during this process.
-	has_rec_base = list(records)
+	has_rec_base = index_records(records)
 	defaults = [
 		(None,  "A",    env["PUBLIC_IP"],       "Required. May have a different value. Sets the IP address that %s resolves to for web hosting and other services besides mail. The A record must be present but its value does not affect mail delivery." % domain),
 		(None,  "AAAA", env.get('PUBLIC_IPV6'), "Optional. Sets the IPv6 address that %s resolves to, e.g. for web hosting. (It is not necessary for receiving mail on this domain.)" % domain),
@@ -243,43 +363,54 @@ def build_zone(domain, all_domains, additional_records, www_redirect_domains, en
 		# (2) there is not a CNAME record already, since you can't set both and who knows what takes precedence
 		# (2) there is not an A record already (if this is an A record this is a dup of (1), and if this is an AAAA record then don't set a default AAAA record if the user sets a custom A record, since the default wouldn't make sense and it should not resolve if the user doesn't provide a new AAAA record)
 		if not has_rec(qname, rtype) and not has_rec(qname, "CNAME") and not has_rec(qname, "A"):
-			records.append((qname, rtype, value, explanation))
+			records.append(Record(qname, rtype, value, explanation))
 
-	# Don't pin the list of records that has_rec checks against anymore.
-	has_rec_base = records
+	# Don't pin the list of records that has_rec checks against anymore. From
+	# here on, add records with add_rec so that the index stays up to date.
+	has_rec_base = index_records(records)
+	def add_rec(rec):
+		records.append(rec)
+		has_rec_base.setdefault((rec.qname, rec.rtype), []).append(rec.value)
 
 	# The MX record says where email for the domain should be delivered: Here!
 	if not has_rec(None, "MX", prefix="10 "):
-		records.append((None,  "MX",  "10 %s." % env["PRIMARY_HOSTNAME"], "Required. Specifies the hostname (and priority) of the machine that handles @%s mail." % domain))
+		add_rec(Record(None,  "MX",  "10 %s." % env["PRIMARY_HOSTNAME"], "Required. Specifies the hostname (and priority) of the machine that handles @%s mail." % domain))
 
 	# SPF record: Permit the box ('mx', see above) to send mail on behalf of
 	# the domain, and no one else.
 	# Skip if the user has set a custom SPF record.
 	if not has_rec(None, "TXT", prefix="v=spf1 "):
-		records.append((None,  "TXT", 'v=spf1 mx -all', "Recommended. Specifies that only the box is permitted to send @%s mail." % domain))
+		add_rec(Record(None,  "TXT", 'v=spf1 mx -all', "Recommended. Specifies that only the box is permitted to send @%s mail." % domain))
 
 	# Append the DKIM TXT record to the zone as generated by OpenDKIM.
 	# Skip if the user has set a DKIM record already.
-	opendkim_record_file = os.path.join(env['STORAGE_ROOT'], 'mail/dkim/mail.txt')
-	with open(opendkim_record_file) as orf:
-		m = re.match(r'(\S+)\s+IN\s+TXT\s+\( ((?:"[^"]+"\s+)+)\)', orf.read(), re.S)
-		val = "".join(re.findall(r'"([^"]+)"', m.group(2)))
-		if not has_rec(m.group(1), "TXT", prefix="v=DKIM1; "):
-			records.append((m.group(1), "TXT", val, "Recommended. Provides a way for recipients to verify that this machine sent @%s mail." % domain))
+	dkim_qname, dkim_value = dkim_record or get_dkim_record(env)
+	if not has_rec(dkim_qname, "TXT", prefix="v=DKIM1; "):
+		add_rec(Record(dkim_qname, "TXT", dkim_value, "Recommended. Provides a way for recipients to verify that this machine sent @%s mail." % domain))
 
 	# Append a DMARC record.
 	# Skip if the user has set a DMARC record already.
 	if not has_rec("_dmarc", "TXT", prefix="v=DMARC1; "):
-		records.append(("_dmarc", "TXT", 'v=DMARC1; p=quarantine', "Recommended. Specifies that mail that does not originate from the box but claims to be from @%s or which does not have a valid DKIM signature is suspect and should be quarantined by the recipient's mail system." % domain))
+		add_rec(Record("_dmarc", "TXT", 'v=DMARC1; p=quarantine', "Recommended. Specifies that mail that does not originate from the box but claims to be from @%s or which does not have a valid DKIM signature is suspect and should be quarantined by the recipient's mail system." % domain))
 
 	# For any subdomain with an A record but no SPF or DMARC record, add strict policy records.
-	all_resolvable_qnames = set(r[0] for r in records if r[1] in ("A", "AAAA"))
+	# Find the names with A records and the names with SPF and DMARC records in one pass.
+	all_resolvable_qnames = set()
+	spf_qnames = set()
+	dmarc_qnames = set()
+	for r in records:
+		if r.rtype in ("A", "AAAA"):
+			all_resolvable_qnames.add(r.qname)
+		elif r.rtype == "TXT" and r.value.startswith("v=spf1 "):
+			spf_qnames.add(r.qname)
+		elif r.rtype == "TXT" and r.value.startswith("v=DMARC1; "):
+			dmarc_qnames.add(r.qname)
 	for qname in all_resolvable_qnames:
-		if not has_rec(qname, "TXT", prefix="v=spf1 "):
-			records.append((qname,  "TXT", 'v=spf1 -all', "Recommended. Prevents use of this domain name for outbound mail by specifying that no servers are valid sources for mail from @%s. If you do send email from this domain name you should either override this record such that the SPF rule does allow the originating server, or, take the recommended approach and have the box handle mail for this domain (simply add any receiving alias at this domain name to make this machine treat the domain name as one of its mail domains)." % (qname + "." + domain)))
+		if qname not in spf_qnames:
+			add_rec(Record(qname,  "TXT", 'v=spf1 -all', "Recommended. Prevents use of this domain name for outbound mail by specifying that no servers are valid sources for mail from @%s. If you do send email from this domain name you should either override this record such that the SPF rule does allow the originating server, or, take the recommended approach and have the box handle mail for this domain (simply add any receiving alias at this domain name to make this machine treat the domain name as one of its mail domains)." % (qname + "." + domain)))
 		dmarc_qname = "_dmarc" + ("" if qname is None else "." + qname)
-		if not has_rec(dmarc_qname, "TXT", prefix="v=DMARC1; "):
-			records.append((dmarc_qname, "TXT", 'v=DMARC1; p=reject', "Recommended. Prevents use of this domain name for outbound mail by specifying that the SPF rule should be honoured for mail from @%s." % (qname + "." + domain)))
+		if dmarc_qname not in dmarc_qnames:
+			add_rec(Record(dmarc_qname, "TXT", 'v=DMARC1; p=reject', "Recommended. Prevents use of this domain name for outbound mail by specifying that the SPF rule should be honoured for mail from @%s." % (qname + "." + domain)))
 
 	# Add CardDAV/CalDAV SRV records on the non-primary hostname that points to the primary hostname
 	# for autoconfiguration of mail clients (so only domains hosting user accounts need it).
@@ -288,7 +419,7 @@ def build_zone(domain, all_domains, additional_records, www_redirect_domains, en
 		for dav in ("card", "cal"):
 			qname = "_" + dav + "davs._tcp"
 			if not has_rec(qname, "SRV"):
-				records.append((qname, "SRV", "0 0 443 " + env["PRIMARY_HOSTNAME"] + ".", "Recommended. Specifies the hostname of the server that handles CardDAV/CalDAV services for email addresses on this domain."))
+				add_rec(Record(qname, "SRV", "0 0 443 " + env["PRIMARY_HOSTNAME"] + ".", "Recommended. Specifies the hostname of the server that handles CardDAV/CalDAV services for email addresses on this domain."))
 
 	# Adds autoconfiguration A records for all domains that there are user accounts at.
 	# This allows the following clients to automatically configure email addresses in the respective applications.
@@ -304,7 +435,7 @@ def build_zone(domain, all_domains, additional_records, www_redirect_domains, en
 		for qname, rtype, value, explanation in autodiscover_records:
 			if value is None or value.strip() == "": continue # skip IPV6 if not set
 			if not has_rec(qname, rtype):
-				records.append((qname, rtype, value, explanation))
+				add_rec(Record(qname, rtype, value, explanation))
 
 	# If this is a domain name that there are email addresses configured for, i.e. "something@"
 	# this domain name, then the domain name is a MTA-STS (https://tools.ietf.org/html/rfc8461)
@@ -362,15 +493,26 @@ def build_zone(domain, all_domains, additional_records, www_redirect_domains, en
 	for qname, rtype, value, explanation in mta_sts_records:
 		if value is None or value.strip() == "": continue # skip IPV6 if not set
 		if not has_rec(qname, rtype):
-			records.append((qname, rtype, value, explanation))
+			add_rec(Record(qname, rtype, value, explanation))
 
 	# Sort the records. The None records *must* go first in the nsd zone file. Otherwise it doesn't matter.
-	records.sort(key = lambda rec : list(reversed(rec[0].split(".")) if rec[0] is not None else ""))
+	records.sort(key = lambda rec : tuple(rec.qname.split(".")[::-1]) if rec.qname is not None else ())
 
 	return records
 
 ########################################################################
 
+def get_file_stamp(fn):
+	# Returns something that changes whenever the file at fn is replaced or
+	# modified, for caching things computed from the file. Returns None if
+	# the file doesn't exist.
+	try:
+		st = os.stat(fn)
+	except FileNotFoundError:
+		return None
+	return (fn, st.st_ino, st.st_mtime_ns, st.st_size)
+
+_tlsa_record = None
 def build_tlsa_record(env):
 	# A DANE TLSA record in DNS specifies that connections on a port
 	# must use TLS and the certificate must match a particular criteria.
@@ -395,6 +537,14 @@ def build_tlsa_record(env):
 	from cryptography.hazmat.primitives.serialization import Encoding, PublicFormat
 
 	fn = os.path.join(env["STORAGE_ROOT"], "ssl", "ssl_certificate.pem")
+
+	# The record only changes when the certificate does, so reuse the last
+	# result if the certificate file hasn't changed.
+	global _tlsa_record
+	cache_key = get_file_stamp(fn)
+	if _tlsa_record is not None and _tlsa_record[0] == cache_key:
+		return _tlsa_record[1]
+
 	cert = load_pem(load_cert_chain(fn)[0])
 
 	subject_public_key = cert.public_key().public_bytes(Encoding.DER, PublicFormat.SubjectPublicKeyInfo)
@@ -406,8 +556,11 @@ def build_tlsa_record(env):
 	# 3: Match the (leaf) certificate. (No CA, no trust path needed.)
 	# 1: Match its subject public key.
 	# 1: Use SHA256.
-	return "3 1 1 " + pk_hash
+	record = "3 1 1 " + pk_hash
+	_tlsa_record = (cache_key, record)
+	return record
 
+_sshfp_records = None
 def build_sshfp_records():
 	# The SSHFP record is a way for us to embed this server's SSH public
 	# key fingerprint into the DNS so that remote hosts have an out-of-band
@@ -420,6 +573,15 @@ def build_sshfp_records():
 	#
 	# See https://github.com/xelerance/sshfp for inspiriation.
 
+	# The records only change when the host keys do, so reuse the last
+	# result if none of the key files have changed.
+	global _sshfp_records
+	cache_key = [get_file_stamp(fn) for fn in sorted(glob.glob('/etc/ssh/ssh_host_*_key.pub'))]
+	if _sshfp_records is None or _sshfp_records[0] != cache_key:
+		_sshfp_records = (cache_key, list(get_sshfp_records()))
+	yield from _sshfp_records[1]
+
+def get_sshfp_records():
 	algorithm_number = {
 		"ssh-rsa": 1,
 		"ssh-dss": 2,
@@ -427,27 +589,17 @@ def build_sshfp_records():
 		"ssh-ed25519": 4,
 	}
 
-	# Get our local fingerprints by running ssh-keyscan. The output looks
-	# like the known_hosts file: hostname, keytype, fingerprint. The order
-	# of the output is arbitrary, so sort it to prevent spurrious updates
-	# to the zone file (that trigger bumping the serial number). However,
-	# if SSH has been configured to listen on a nonstandard port, we must
-	# specify that port to sshkeyscan.
-	port = 22
-	with open('/etc/ssh/sshd_config', 'r') as f:
-		for line in f:
-			s = line.rstrip().split()
-			if len(s) == 2 and s[0] == 'Port':
-				try:
-					port = int(s[1])
-				except ValueError:
-					pass
-				break
-	keys = shell("check_output", ["ssh-keyscan", "-t", "rsa,dsa,ecdsa,ed25519", "-p", str(port), "localhost"])
-	for key in sorted(keys.split("\n")):
-		if key.strip() == "" or key[0] == "#": continue
+	# Get our local fingerprints by reading the host public key files, which
+	# look like lines in an authorized_keys file: keytype, key, comment. The
+	# order of the files is arbitrary, so sort the keys to prevent spurrious
+	# updates to the zone file (that trigger bumping the serial number).
+	keys = []
+	for fn in glob.glob('/etc/ssh/ssh_host_*_key.pub'):
+		with open(fn) as f:
+			keys.append(f.read())
+	for key in sorted(keys):
 		try:
-			host, keytype, pubkey = key.split(" ")
+			keytype, pubkey = key.split()[0:2]
 			yield "%d %d ( %s )" % (
 				algorithm_number[keytype],
 				2, # specifies we are using SHA-256 on next line
@@ -488,51 +640,26 @@ $TTL 1800           ; default time to live
 	# Replace replacement strings.
 	zone = zone.format(domain=domain, primary_domain=env["PRIMARY_HOSTNAME"])
 
-	# Add records.
-	for subdomain, querytype, value, explanation in records:
-		if subdomain:
-			zone += subdomain
-		zone += "\tIN\t" + querytype + "\t"
-		if querytype == "TXT":
-			# Divide into 255-byte max substrings.
-			v2 = ""
-			while len(value) > 0:
-				s = value[0:255]
-				value = value[255:]
-				s = s.replace('\\', '\\\\') # escape backslashes
-				s = s.replace('"', '\\"') # escape quotes
-				s = '"' + s + '"' # wrap in quotes
-				v2 += s + " "
-			value = v2
-		zone += value + "\n"
+	# Add records. Collect the parts in a list and join them once at the end
+	# rather than building up the string record by record.
+	parts = [zone]
+	for record in records:
+		if record.qname:
+			parts.append(record.qname)
+		parts.append("\tIN\t" + record.rtype + "\t")
+		if record.rtype == "TXT":
+			parts.append(format_txt_value(record.value))
+		else:
+			parts.append(record.value)
+		parts.append("\n")
+	zone = "".join(parts)
 
 	# DNSSEC requires re-signing a zone periodically. That requires
 	# bumping the serial number even if no other records have changed.
 	# We don't see the DNSSEC records yet, so we have to figure out
 	# if a re-signing is necessary so we can prematurely bump the
 	# serial number.
-	force_bump = False
-	if not os.path.exists(zonefile + ".signed"):
-		# No signed file yet. Shouldn't normally happen unless a box
-		# is going from not using DNSSEC to using DNSSEC.
-		force_bump = True
-	else:
-		# We've signed the domain. Check if we are close to the expiration
-		# time of the signature. If so, we'll force a bump of the serial
-		# number so we can re-sign it.
-		with open(zonefile + ".signed") as f:
-			signed_zone = f.read()
-		expiration_times = re.findall(r"\sRRSIG\s+SOA\s+\d+\s+\d+\s\d+\s+(\d{14})", signed_zone)
-		if len(expiration_times) == 0:
-			# weird
-			force_bump = True
-		else:
-			# All of the times should be the same, but if not choose the soonest.
-			expiration_time = min(expiration_times)
-			expiration_time = datetime.datetime.strptime(expiration_time, "%Y%m%d%H%M%S")
-			if expiration_time - datetime.datetime.now() < datetime.timedelta(days=3):
-				# We're within three days of the expiration, so bump serial & resign.
-				force_bump = True
+	force_bump = is_zone_signature_expiring(zonefile)
 
 	# Set the serial number.
 	serial = datetime.datetime.now().strftime("%Y%m%d00")
@@ -541,12 +668,17 @@ $TTL 1800           ; default time to live
 		# increment the number.
 		with open(zonefile) as f:
 			existing_zone = f.read()
-			m = re.search(r"(\d+)\s*;\s*serial number", existing_zone)
-			if m:
+
+			# The serial number line was written by us above, so rather than
+			# searching the whole file with a regex, find the comment and
+			# read the digits just before it.
+			serial_end = existing_zone.find("; serial number")
+			head = existing_zone[:serial_end].rstrip()
+			existing_serial = head[len(head.rstrip("0123456789")):]
+			if serial_end != -1 and existing_serial:
 				# Clear out the serial number in the existing zone file for the
 				# purposes of seeing if anything *else* in the zone has changed.
-				existing_serial = m.group(1)
-				existing_zone = existing_zone.replace(m.group(0), "__SERIAL__     ; serial number")
+				existing_zone = head[:-len(existing_serial)] + "__SERIAL__     " + existing_zone[serial_end:]
 
 				# If the existing zone is the same as the new zone (modulo the serial number),
 				# there is no need to update the file. Unless we're forcing a bump.
@@ -568,6 +700,48 @@ $TTL 1800           ; default time to live
 
 	return True # file is updated
 
+@functools.lru_cache(maxsize=1024)
+def format_txt_value(value):
+	# Divide into 255-byte max substrings, escape backslashes and quotes,
+	# and wrap each in quotes. The same TXT values (SPF, DMARC, DKIM) appear
+	# in most zones, so remember the results.
+	return "".join('"' + value[i:i+255].translate(TXT_ESCAPES) + '" '
+		for i in range(0, len(value), 255))
+
+def is_zone_signature_expiring(zonefile):
+	if not os.path.exists(zonefile + ".signed"):
+		# No signed file yet. Shouldn't normally happen unless a box
+		# is going from not using DNSSEC to using DNSSEC.
+		return True
+
+	# We've signed the domain. Check if we are close to the expiration
+	# time of the signature.
+	#
+	# All of the signatures expire at the same time, so just find the
+	# one over the SOA record, which is near the top of the file, and
+	# stop reading there. Let dnspython parse the record's data rather
+	# than picking out the expiration time ourselves.
+	with open(zonefile + ".signed") as f:
+		for line in f:
+			if "RRSIG" not in line: continue
+			fields = line.split()
+			i = fields.index("RRSIG") if "RRSIG" in fields else -1
+			if i >= 0 and fields[i+1:i+2] == ["SOA"]:
+				try:
+					rrsig = dns.rdata.from_text(dns.rdataclass.IN, dns.rdatatype.RRSIG, " ".join(fields[i+1:]))
+				except Exception:
+					# weird
+					return True
+				break
+		else:
+			# weird
+			return True
+
+	# Are we within three days of the expiration? (The expiration time
+	# is a POSIX timestamp.)
+	expiration_time = datetime.datetime.fromtimestamp(rrsig.expiration, datetime.timezone.utc)
+	return expiration_time - datetime.datetime.now(datetime.timezone.utc) < datetime.timedelta(days=3)
+
 ########################################################################
 
 def write_nsd_conf(zonefiles, additional_records, env):
@@ -629,7 +803,8 @@ def sign_zone(domain, zonefile, env):
 	# can reuse the same key, but it won't validate without a DNSSEC
 	# record specifically for the domain.
 	#
-	# Copy the .key and .private files to /tmp to patch them up.
+	# Copy the .key and .private files to /tmp to patch them up. Include
+	# our process ID in the file name since zones are signed in parallel.
 	#
 	# Use os.umask and open().write() to securely create a copy that only
 	# we (root) can read.
@@ -637,7 +812,7 @@ def sign_zone(domain, zonefile, env):
 	for key in ("KSK", "ZSK"):
 		if dnssec_keys.get(key, "").strip() == "": raise Exception("DNSSEC is not properly set up.")
 		oldkeyfn = os.path.join(env['STORAGE_ROOT'], 'dns/dnssec/' + dnssec_keys[key])
-		newkeyfn = '/tmp/' + dnssec_keys[key].replace("_domain_", domain)
+		newkeyfn = '/tmp/%d-' % os.getpid() + dnssec_keys[key].replace("_domain_", domain)
 		dnssec_keys[key] = newkeyfn
 		for ext in (".private", ".key"):
 			if not os.path.exists(oldkeyfn + ext): raise Exception("DNSSEC is not properly set up.")
@@ -713,7 +888,7 @@ def write_opendkim_tables(domains, env):
 		# So we must have a separate KeyTable entry for each domain.
 		"SigningTable":
 			"".join(
-				"*@{domain} {domain}\n".format(domain=domain)
+				f"*@{domain} {domain}\n"
 				for domain in domains
 			),
 
@@ -722,23 +897,35 @@ def write_opendkim_tables(domains, env):
 		# signing domain must match the sender's From: domain.
 		"KeyTable":
 			"".join(
-				"{domain} {domain}:mail:{key_file}\n".format(domain=domain, key_file=opendkim_key_file)
+				f"{domain} {domain}:mail:{opendkim_key_file}\n"
 				for domain in domains
 			),
 	}
 
 	did_update = False
 	for filename, content in config.items():
-		# Don't write the file if it doesn't need an update.
-		if os.path.exists("/etc/opendkim/" + filename):
-			with open("/etc/opendkim/" + filename) as f:
-				if f.read() == content:
+		# Don't write the file if it doesn't need an update. We keep a hash
+		# of what we last wrote next to each file so that we don't have to
+		# read back the whole table to tell. The file's stamp is kept with
+		# it so that we notice if anything else changes the file.
+		fn = "/etc/opendkim/" + filename
+		content_hash = hashlib.blake2b(content.encode("utf8"), digest_size=16).hexdigest()
+		if os.path.exists(fn + ".hash"):
+			with open(fn + ".hash") as f:
+				if f.read() == repr((content_hash, get_file_stamp(fn))):
 					continue
 
-		# The contents needs to change.
-		with open("/etc/opendkim/" + filename, "w") as f:
-			f.write(content)
-		did_update = True
+		# The contents may need to change.
+		existing_content = None
+		if os.path.exists(fn):
+			with open(fn) as f:
+				existing_content = f.read()
+		if existing_content != content:
+			with open(fn, "w") as f:
+				f.write(content)
+			did_update = True
+		with open(fn + ".hash", "w") as f:
+			f.write(repr((content_hash, get_file_stamp(fn))))
 
 	# Return whether the files changed. If they didn't change, there's
 	# no need to kick the opendkim process.
@@ -746,12 +933,22 @@ def write_opendkim_tables(domains, env):
 
 ########################################################################
 
+_custom_dns = None
 def get_custom_dns_config(env):
-	try:
-		custom_dns = rtyaml.load(open(os.path.join(env['STORAGE_ROOT'], 'dns/custom.yaml')))
-		if not isinstance(custom_dns, dict): raise ValueError() # caught below
-	except:
-		return [ ]
+	# Parsing YAML is slow, so reuse the last parsed result if the file
+	# hasn't changed since.
+	global _custom_dns
+	fn = os.path.join(env['STORAGE_ROOT'], 'dns/custom.yaml')
+	cache_key = get_file_stamp(fn)
+	if _custom_dns is not None and _custom_dns[0] == cache_key:
+		custom_dns = _custom_dns[1]
+	else:
+		try:
+			custom_dns = rtyaml.load(open(fn))
+			if not isinstance(custom_dns, dict): raise ValueError() # caught below
+		except:
+			return [ ]
+		_custom_dns = (cache_key, custom_dns)
 
 	for qname, value in custom_dns.items():
 		# Short form. Mapping a domain name to a string is short-hand
@@ -828,11 +1025,23 @@ def write_custom_dns_config(config, env):
 					values = values[0]
 				dns[qname][rtype] = values
 
-	# Write.
+	# Write, unless the file already has exactly this content.
+	global _custom_dns, _zones
+	fn = os.path.join(env['STORAGE_ROOT'], 'dns/custom.yaml')
 	config_yaml = rtyaml.dump(dns)
-	with open(os.path.join(env['STORAGE_ROOT'], 'dns/custom.yaml'), "w") as f:
+	if os.path.exists(fn):
+		with open(fn) as f:
+			if f.read() == config_yaml:
+				return
+	with open(fn, "w") as f:
 		f.write(config_yaml)
 
+	# Update the cache used by get_custom_dns_config so that it doesn't
+	# have to parse what we just wrote, and drop the records built from
+	# the old settings.
+	_custom_dns = (get_file_stamp(fn), dns)
+	_zones = None
+
 def set_custom_dns_record(qname, rtype, value, action, env):
 	# validate qname
 	for zone, fn in get_dns_zones(env):
@@ -848,7 +1057,7 @@ def set_custom_dns_record(qname, rtype, value, action, env):
 	# validate rtype
 	rtype = rtype.upper()
 	if value is not None and qname != "_secondary_nameserver":
-		if not re.search(DOMAIN_RE, qname):
+		if not DOMAIN_RE.search(qname):
 			raise ValueError("Invalid name.")
 
 		if rtype in ("A", "AAAA"):
@@ -864,7 +1073,7 @@ def set_custom_dns_record(qname, rtype, value, action, env):
 			if not value.endswith("."):
 				value = value + "."
 
-			if not re.search(DOMAIN_RE, value):
+			if not DOMAIN_RE.search(value):
 				raise ValueError("Invalid value.")
 		elif rtype in ("CNAME", "TXT", "SRV", "MX", "SSHFP", "CAA"):
 			# anything goes
@@ -1002,24 +1211,21 @@ def build_recommended_dns(env):
 	ret = []
 	for (domain, zonefile, records) in build_zones(env):
 		# remove records that we don't dislay
-		records = [r for r in records if r[3] is not False]
+		records = [r for r in records if r.explanation is not False]
 
 		# put Required at the top, then Recommended, then everythiing else
-		records.sort(key = lambda r : 0 if r[3].startswith("Required.") else (1 if r[3].startswith("Recommended.") else 2))
+		records.sort(key = lambda r : 0 if r.explanation.startswith("Required.") else (1 if r.explanation.startswith("Recommended.") else 2))
 
 		# expand qnames
-		for i in range(len(records)):
-			if records[i][0] == None:
-				qname = domain
-			else:
-				qname = records[i][0] + "." + domain
-
-			records[i] = {
-				"qname": qname,
-				"rtype": records[i][1],
-				"value": records[i][2],
-				"explanation": records[i][3],
+		records = [
+			{
+				"qname": domain if r.qname is None else r.qname + "." + domain,
+				"rtype": r.rtype,
+				"value": r.value,
+				"explanation": r.explanation,
 			}
+			for r in records
+		]
 
 		# return
 		ret.append((domain, records))